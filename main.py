@@ -1,36 +1,128 @@
 # main.py
 
-import json
+import asyncio
+import hashlib
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from typing import AsyncGenerator, List, Optional
 
 import httpx
+import orjson
 import sqlmodel
-from fastapi import FastAPI, HTTPException
+from fastapi import Depends, FastAPI, HTTPException, Request
 from fastapi.responses import HTMLResponse, Response, StreamingResponse
-from sqlmodel import Field, Relationship, Session, SQLModel, create_engine, select
+from sqlalchemy import Text, TypeDecorator, bindparam, event
+from sqlmodel import Field, Index, Relationship, Session, SQLModel, create_engine, delete, func, insert, select
 
 # --- 1. 数据库模型定义 ---
+# STRICT 表需要 SQLite 3.37+，更早的版本仍按普通表创建
+SQLITE_STRICT = sqlite3.sqlite_version_info >= (3, 37, 0)
+
+class TextDateTime(TypeDecorator):
+    """以 TEXT 存储的 datetime，格式与 SQLAlchemy 的 SQLite DATETIME 相同 (STRICT 表不接受 DATETIME 类型名)"""
+    impl = Text
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return value.isoformat(" ", timespec="microseconds") if value is not None else None
+
+    def process_result_value(self, value, dialect):
+        return datetime.fromisoformat(value) if value is not None else None
+
 class Conversation(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     title: str = Field(index=True)
     created_at: datetime = Field(default_factory=datetime.utcnow, nullable=False)
-    messages: List["ChatMessage"] = Relationship(back_populates="conversation", sa_relationship_kwargs={"cascade": "all, delete-orphan"})
+    # 子消息由数据库的 ON DELETE CASCADE 删除，ORM 不再逐条加载和删除
+    messages: List["ChatMessage"] = Relationship(back_populates="conversation", passive_deletes=True)
 
 class ChatMessage(SQLModel, table=True):
+    # 按对话筛选并按时间排序的查询可以直接走这个索引，无需额外排序；倒序查询由 SQLite 反向扫描同一索引完成
+    # STRICT 表按声明的类型存储并校验每一列，所以字符串列用 TEXT、时间列用 TextDateTime
+    __table_args__ = (Index("ix_chatmessage_conv_created", "conversation_id", "created_at"), {"sqlite_strict": SQLITE_STRICT})
     id: Optional[int] = Field(default=None, primary_key=True)
-    role: str
-    content: str
-    created_at: datetime = Field(default_factory=datetime.utcnow, nullable=False)
-    conversation_id: Optional[int] = Field(default=None, foreign_key="conversation.id")
+    role: str = Field(sa_type=Text)
+    content: str = Field(sa_type=Text)
+    created_at: datetime = Field(default_factory=datetime.utcnow, nullable=False, sa_type=TextDateTime)
+    conversation_id: Optional[int] = Field(default=None, foreign_key="conversation.id", ondelete="CASCADE")
     conversation: Optional[Conversation] = Relationship(back_populates="messages")
 
 # --- 2. 数据库设置 ---
 DATABASE_FILE = "database.db"
 engine = create_engine(f"sqlite:///{DATABASE_FILE}", connect_args={"check_same_thread": False})
 
+# WAL 模式下读写互不阻塞，synchronous=NORMAL 让每次提交不再等待完整的 fsync
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",     # 64 MiB 页缓存
+    "PRAGMA mmap_size=268435456",   # 256 MiB 内存映射
+    "PRAGMA foreign_keys=ON",
+)
+
+@event.listens_for(engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    # 除 journal_mode 外，这些 PRAGMA 都只对当前连接生效，所以连接池里的每个新连接都要设置一次
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS: cursor.execute(pragma)
+    cursor.close()
+
+def migrate_chatmessage_table(conn):
+    """SQLite 不能 ALTER 已有的约束和表选项：旧库的外键缺少 ON DELETE CASCADE 或表不是 STRICT 时，按当前模型重建 chatmessage 表并迁移数据"""
+    foreign_keys = conn.exec_driver_sql("PRAGMA foreign_key_list(chatmessage)").fetchall()
+    is_strict = SQLITE_STRICT and conn.exec_driver_sql("PRAGMA table_list(chatmessage)").fetchone().strict
+    if all(fk.on_delete == "CASCADE" for fk in foreign_keys) and is_strict == SQLITE_STRICT: return
+    table = ChatMessage.__table__
+    columns = ", ".join(column.name for column in table.columns)
+    conn.exec_driver_sql("BEGIN") # pysqlite 不会为 DDL 自动开启事务，显式开启以保证整个重建是原子的
+    conn.exec_driver_sql("ALTER TABLE chatmessage RENAME TO chatmessage_old")
+    for index in table.indexes: conn.exec_driver_sql(f"DROP INDEX IF EXISTS {index.name}")
+    table.create(conn)
+    # 所属对话早已删除的孤儿消息无法满足外键约束，直接丢弃
+    conn.exec_driver_sql(f"INSERT INTO chatmessage ({columns}) SELECT {columns} FROM chatmessage_old WHERE conversation_id IS NULL OR conversation_id IN (SELECT id FROM conversation)")
+    conn.exec_driver_sql("DROP TABLE chatmessage_old")
+
 def create_db_and_tables():
     SQLModel.metadata.create_all(engine)
+    with engine.begin() as conn: migrate_chatmessage_table(conn)
+    # create_all 会跳过已存在的表及其索引，旧数据库需要单独补建 (CREATE INDEX IF NOT EXISTS)
+    for index in ChatMessage.__table__.indexes: index.create(engine, checkfirst=True)
+
+# 热点语句在导入时构建一次，参数通过 bindparam 传入：SQLAlchemy 命中编译缓存，SQLite 命中连接上的语句缓存
+CONVERSATION_MESSAGES_QUERY = (
+    select(ChatMessage)
+    .where(ChatMessage.conversation_id == bindparam("conversation_id"))
+    .order_by(ChatMessage.created_at)
+)
+# 用窗口函数从最新一条开始累计字符数，由 SQLite 直接截掉超出预算的旧消息并按时间正序返回
+# 直接交给驱动执行，返回普通元组，不经过 ORM 和 SQLAlchemy 的语句编译
+HISTORY_SQL = """
+    SELECT role, content, total_chars FROM (
+        SELECT role, content, created_at, id,
+               SUM(length(content)) OVER (ORDER BY created_at DESC, id DESC) AS total_chars
+        FROM chatmessage WHERE conversation_id = ?
+        ORDER BY created_at DESC, id DESC LIMIT ?
+    ) WHERE total_chars <= ? ORDER BY created_at, id
+"""
+# 简单的 Token 估算：1个 token 约等于 4 个英文字符或 1-2 个中文字符。我们用字符数除以 2.5 作为估算。
+CONTEXT_CHAR_LIMIT = 4096 * 2 # 假设 4096 tokens, 留出一半给模型生成
+HISTORY_MESSAGE_LIMIT = 200 # 最多取最近 200 条，避免长对话把全部历史读入内存
+INSERT_MESSAGE_SQL = "INSERT INTO chatmessage (role, content, created_at, conversation_id) VALUES (?, ?, ?, ?) RETURNING id"
+
+# 异步端点里的数据库操作都放到线程里执行，避免 SQLite 的提交/fsync 阻塞事件循环。
+# 聊天流程中的写操作 (连同同一事务里的上下文读取) 排进单线程队列，彼此串行执行；
+# 重命名、删除等同步端点仍在 FastAPI 的线程池中直接提交，与之并发时由 SQLite 的文件锁协调。
+# 写线程 (app.state.db_writer) 随应用启动创建、关闭时销毁
+def run_db_write(fn, *args):
+    return asyncio.get_running_loop().run_in_executor(app.state.db_writer, fn, *args)
+
+def get_session():
+    """FastAPI 依赖：每个请求只检出一次连接、共用一个 Session，请求结束后归还连接池"""
+    with Session(engine) as session:
+        yield session
 
 # --- 3. FastAPI 应用 ---
 app = FastAPI()
@@ -39,50 +131,88 @@ OLLAMA_HOST = "http://localhost:11434"
 @app.on_event("startup")
 def on_startup():
     create_db_and_tables()
+    app.state.db_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+    # 首页只在启动时读一次，之后直接从内存返回，并用 ETag 支持条件请求
+    try:
+        with open("index.html", "rb") as f: app.state.index_bytes = f.read()
+        app.state.index_etag = f'"{hashlib.md5(app.state.index_bytes, usedforsecurity=False).hexdigest()}"'
+    except FileNotFoundError:
+        app.state.index_bytes = None
+    # 全局复用一个 HTTP 客户端，避免每次调用 Ollama 都重新建立 TCP 连接和连接池
+    app.state.http = httpx.AsyncClient(
+        base_url=OLLAMA_HOST,
+        timeout=httpx.Timeout(60.0),
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+        headers={"Connection": "keep-alive", "Accept-Encoding": "gzip"},
+    )
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await app.state.http.aclose()
+    # 等待队列中剩余的写入完成，放到线程里等待以免阻塞事件循环
+    await asyncio.to_thread(app.state.db_writer.shutdown, wait=True)
 
 # --- 4. API 端点 ---
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """按 If-None-Match 的弱比较规则判断是否命中：支持 *、逗号分隔的多个标签以及 W/ 前缀"""
+    if not if_none_match: return False
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    return "*" in tags or any(tag.removeprefix("W/") == etag for tag in tags)
 @app.get("/", response_class=HTMLResponse)
-async def read_root():
-    try:
-        with open("index.html", "r", encoding="utf-8") as f: return HTMLResponse(content=f.read(), status_code=200)
-    except FileNotFoundError:
+async def read_root(request: Request):
+    if app.state.index_bytes is None:
         return HTMLResponse(content="<h1>错误：找不到 index.html</h1>", status_code=404)
+    headers = {"ETag": app.state.index_etag, "Cache-Control": "no-cache"}
+    if etag_matches(request.headers.get("if-none-match"), app.state.index_etag): return Response(status_code=304, headers=headers)
+    return HTMLResponse(content=app.state.index_bytes, status_code=200, headers=headers)
 @app.get("/favicon.ico", include_in_schema=False)
 async def favicon():
     return Response(status_code=204)
-@app.get("/api/conversations", response_model=List[Conversation])
-def get_conversations():
-    with Session(engine) as session:
-        return session.exec(select(Conversation).order_by(Conversation.created_at.desc())).all()
+class ConversationSummary(SQLModel):
+    id: int
+    title: str
+    created_at: datetime
+    last_message_at: Optional[datetime] = None
+@app.get("/api/conversations", response_model=List[ConversationSummary])
+def get_conversations(session: Session = Depends(get_session)):
+    # 一次查询同时取出列表和每个对话最后一条消息的时间 (走 conversation_id, created_at 索引)，按最近活跃排序
+    last_message_at = func.max(ChatMessage.created_at).label("last_message_at")
+    return session.exec(
+        select(Conversation.id, Conversation.title, Conversation.created_at, last_message_at)
+        .join(ChatMessage, isouter=True)
+        .group_by(Conversation.id)
+        .order_by(func.coalesce(last_message_at, Conversation.created_at).desc())
+    ).all()
 @app.get("/api/conversations/{conversation_id}", response_model=List[ChatMessage])
-def get_conversation_messages(conversation_id: int):
-    with Session(engine) as session:
-        return session.exec(select(ChatMessage).where(ChatMessage.conversation_id == conversation_id).order_by(ChatMessage.created_at)).all()
+def get_conversation_messages(conversation_id: int, session: Session = Depends(get_session)):
+    return session.exec(CONVERSATION_MESSAGES_QUERY, params={"conversation_id": conversation_id}).all()
+MODELS_CACHE_TTL = 10 # 模型列表很少变化，成功结果在内存中缓存 10 秒
+_models_cache = {"ts": float("-inf"), "data": []}
 @app.get("/api/models")
 async def get_models():
-    async with httpx.AsyncClient() as client:
-        try:
-            response = await client.get(f"{OLLAMA_HOST}/api/tags")
-            response.raise_for_status()
-            return response.json().get("models", [])
-        except Exception: return []
+    if time.monotonic() - _models_cache["ts"] < MODELS_CACHE_TTL: return _models_cache["data"]
+    try:
+        response = await app.state.http.get("/api/tags")
+        response.raise_for_status()
+        models = response.json().get("models", [])
+    except Exception: return []
+    _models_cache.update(ts=time.monotonic(), data=models)
+    return models
 class TitleUpdateRequest(SQLModel):
     title: str
 @app.put("/api/conversations/{conversation_id}/title", response_model=Conversation)
-def update_conversation_title(conversation_id: int, request: TitleUpdateRequest):
-    with Session(engine) as session:
-        conversation = session.get(Conversation, conversation_id)
-        if not conversation: raise HTTPException(status_code=404, detail="Conversation not found")
-        conversation.title = request.title
-        session.add(conversation); session.commit(); session.refresh(conversation)
-        return conversation
+def update_conversation_title(conversation_id: int, request: TitleUpdateRequest, session: Session = Depends(get_session)):
+    conversation = session.get(Conversation, conversation_id)
+    if not conversation: raise HTTPException(status_code=404, detail="Conversation not found")
+    conversation.title = request.title
+    session.add(conversation); session.commit(); session.refresh(conversation)
+    return conversation
 @app.delete("/api/conversations/{conversation_id}", status_code=204)
-def delete_conversation(conversation_id: int):
-    with Session(engine) as session:
-        conversation = session.get(Conversation, conversation_id)
-        if not conversation: raise HTTPException(status_code=404, detail="Conversation not found")
-        session.delete(conversation); session.commit()
-        return Response(status_code=204)
+def delete_conversation(conversation_id: int, session: Session = Depends(get_session)):
+    result = session.exec(delete(Conversation).where(Conversation.id == conversation_id))
+    if result.rowcount == 0: raise HTTPException(status_code=404, detail="Conversation not found")
+    session.commit()
+    return Response(status_code=204)
 
 class ChatRequest(SQLModel):
     prompt: str
@@ -93,101 +223,137 @@ class RegenerateRequest(SQLModel):
     new_prompt: str
     model: str
 
-async def stream_ollama_response(request: ChatRequest, conversation_id: int) -> AsyncGenerator[str, None]:
-    """一个异步生成器，用于构建上下文、流式处理 Ollama 的响应并保存到数据库"""
+# SSE 帧直接以 bytes 产出，StreamingResponse 无需再对每个 token 做一次 str -> UTF-8 编码
+SSE_PREFIX = b"data: "
+SSE_SUFFIX = b"\n\n"
+
+def sse_event(data) -> bytes:
+    return SSE_PREFIX + orjson.dumps(data) + SSE_SUFFIX
+
+def save_assistant_message(content: str, conversation_id: int, created_at: datetime) -> Optional[int]:
+    """用一条 INSERT ... RETURNING 保存助手回复，省去 ORM 的 flush 和 refresh 查询，返回新消息的 id；对话已被删除时返回 None"""
+    conn = engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(INSERT_MESSAGE_SQL, ("assistant", content, created_at.isoformat(" ", timespec="microseconds"), conversation_id))
+        except sqlite3.IntegrityError: # 生成过程中对话被删除，外键约束拒绝写入，回复直接丢弃
+            conn.rollback(); return None
+        (message_id,) = cursor.fetchone()
+        cursor.close(); conn.commit()
+    finally:
+        conn.close()
+    return message_id
+
+def load_context_history(session: Session, conversation_id: int) -> list:
+    """在当前事务中读取落在字符预算内的最近历史消息 (role, content, total_chars)，按时间正序"""
+    return session.connection().exec_driver_sql(HISTORY_SQL, (conversation_id, HISTORY_MESSAGE_LIMIT, CONTEXT_CHAR_LIMIT)).fetchall()
+
+async def stream_ollama_response(request: ChatRequest, conversation_id: int, history: list) -> AsyncGenerator[bytes, None]:
+    """一个异步生成器，用于根据已读取的历史构建上下文、流式处理 Ollama 的响应并保存到数据库"""
     
     # --- 1. 构建上下文 (Context Building) ---
-    messages_for_ollama = []
-    
-    # 简单的 Token 估算：1个 token 约等于 4 个英文字符或 1-2 个中文字符。我们用字符数除以 2.5 作为估算。
-    CONTEXT_CHAR_LIMIT = 4096 * 2 # 假设 4096 tokens, 留出一半给模型生成
-    current_chars = 0
-
-    with Session(engine) as session:
-        # 从数据库中获取此对话的所有历史记录，按时间倒序
-        history = session.exec(
-            select(ChatMessage)
-            .where(ChatMessage.conversation_id == conversation_id)
-            .order_by(ChatMessage.created_at.desc())
-        ).all()
-        
-        # 从后往前遍历历史记录，构建上下文
-        for msg in history:
-            msg_chars = len(msg.content)
-            if current_chars + msg_chars > CONTEXT_CHAR_LIMIT:
-                break # 超出预算，停止添加
-            
-            messages_for_ollama.append({"role": msg.role, "content": msg.content})
-            current_chars += msg_chars
-            
-    # 因为我们是倒序添加的，所以需要反转回来，让对话顺序正确
-    messages_for_ollama.reverse()
+    messages_for_ollama = [{"role": role, "content": content} for role, content, _ in history]
+    current_chars = history[0].total_chars if history else 0 # 正序的第一条即为累计总字符数
     
     print(f"--- Context for Ollama: {len(messages_for_ollama)} messages, approx {current_chars / 2.5:.0f} tokens ---")
 
     # --- 2. 流式请求 (Streaming Request) ---
+    # 攒够 16 个 token 或距上次发送超过 20 ms 才合并成一帧 SSE 发出，减少逐 token 写入的开销
+    SSE_FLUSH_TOKENS = 16
+    SSE_FLUSH_INTERVAL = 0.02
     full_response_content = ""
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        async with client.stream("POST", f"{OLLAMA_HOST}/api/chat", json={
-            "model": request.model,
-            "messages": messages_for_ollama, 
-            "stream": True
-        }) as response:
-            if response.status_code != 200:
-                error_content = await response.aread(); yield f"data: {json.dumps({'error': f'Ollama API Error: {error_content.decode()}'})}\n\n"; return
-            
-            async for line in response.aiter_lines():
-                if line:
-                    try:
-                        chunk = json.loads(line); content_piece = chunk.get("message", {}).get("content")
-                        if content_piece:
-                            full_response_content += content_piece; yield f"data: {json.dumps({'content': content_piece})}\n\n"
-                        if chunk.get("done"):
-                            with Session(engine) as session:
-                                assistant_message = ChatMessage(role="assistant", content=full_response_content, conversation_id=conversation_id)
-                                session.add(assistant_message); session.commit(); session.refresh(assistant_message)
-                                yield f"data: {json.dumps({'done': True, 'message': assistant_message.model_dump(mode='json')})}\n\n"
-                    except json.JSONDecodeError: pass
+    pending_pieces = []
+    loop = asyncio.get_running_loop(); last_flush = loop.time()
+    async with app.state.http.stream("POST", "/api/chat", json={
+        "model": request.model,
+        "messages": messages_for_ollama, 
+        "stream": True
+    }) as response:
+        if response.status_code != 200:
+            error_content = await response.aread(); yield sse_event({'error': f'Ollama API Error: {error_content.decode()}'}); return
+        
+        # Ollama 的行格式 ({"message": {"content": ...}, "done": ...}) 与前端读取的 {"content": ...} / {"done", "message"} 帧不同，
+        # 且保存回复需要拼接后的正文，所以每行仍需解析；重新编码只在合并后的每次 flush 时发生一次
+        async for line in response.aiter_lines():
+            if line:
+                try:
+                    chunk = orjson.loads(line); content_piece = chunk.get("message", {}).get("content")
+                    if content_piece:
+                        full_response_content += content_piece; pending_pieces.append(content_piece)
+                        now = loop.time()
+                        if len(pending_pieces) >= SSE_FLUSH_TOKENS or now - last_flush > SSE_FLUSH_INTERVAL:
+                            yield sse_event({'content': ''.join(pending_pieces)})
+                            pending_pieces.clear(); last_flush = now
+                    if chunk.get("done"):
+                        if pending_pieces: # 结束前先把缓冲里剩余的内容发出去
+                            yield sse_event({'content': ''.join(pending_pieces)}); pending_pieces.clear()
+                        # 先把 done 帧发给前端 (它只用到 created_at)，写库在后台同时进行；提交完成后再补发带 id 的 saved 帧。
+                        # 前端收到 done 后可能随时断开连接，shield 保证生成器被取消时写入任务不会被一并取消
+                        created_at = datetime.utcnow()
+                        saving = run_db_write(save_assistant_message, full_response_content, conversation_id, created_at)
+                        assistant_message = {"id": None, "role": "assistant", "content": full_response_content, "created_at": created_at.isoformat(), "conversation_id": conversation_id}
+                        yield sse_event({'done': True, 'message': assistant_message})
+                        assistant_message["id"] = await asyncio.shield(saving)
+                        if assistant_message["id"] is None: yield sse_event({'error': 'Conversation was deleted, reply not saved'})
+                        else: yield sse_event({'saved': True, 'message': assistant_message})
+                except orjson.JSONDecodeError: pass
+        if pending_pieces: # 连接在 done 之前中断时也不丢弃已收到的内容
+            yield sse_event({'content': ''.join(pending_pieces)})
 
-@app.post("/api/chat")
-async def chat_stream(request: ChatRequest):
+def insert_chat_message(session: Session, role: str, content: str, conversation_id: int) -> dict:
+    """用 INSERT ... RETURNING 在当前事务中写入一条消息，省去 refresh 查询，返回与 model_dump(mode='json') 相同的字段"""
+    created_at = datetime.utcnow()
+    message_id = session.exec(insert(ChatMessage).values(role=role, content=content, created_at=created_at, conversation_id=conversation_id).returning(ChatMessage.id)).scalar_one()
+    return {"id": message_id, "role": role, "content": content, "created_at": created_at.isoformat(), "conversation_id": conversation_id}
+
+def create_chat_turn(request: ChatRequest) -> tuple[dict, list]:
+    """按需新建对话并保存用户消息，在同一事务中读出上下文历史；返回发给前端的第一帧数据和历史"""
     with Session(engine) as session:
         if request.conversation_id is None:
-            conversation = Conversation(title=request.prompt[:50]); session.add(conversation); session.commit(); session.refresh(conversation)
+            conversation_id = session.exec(insert(Conversation).values(title=request.prompt[:50], created_at=datetime.utcnow()).returning(Conversation.id)).scalar_one()
         else:
-            conversation = session.get(Conversation, request.conversation_id)
-            if not conversation: raise HTTPException(status_code=404, detail="Conversation not found")
-        user_message = ChatMessage(role="user", content=request.prompt, conversation_id=conversation.id)
-        session.add(user_message); session.commit(); session.refresh(user_message)
-        initial_data = {"user_message": user_message.model_dump(mode='json'), "conversation_id": conversation.id}
-    
+            conversation_id = session.exec(select(Conversation.id).where(Conversation.id == request.conversation_id)).first()
+            if conversation_id is None: raise HTTPException(status_code=404, detail="Conversation not found")
+        user_message = insert_chat_message(session, "user", request.prompt, conversation_id)
+        history = load_context_history(session, conversation_id) # 同一事务内已能读到刚插入的用户消息
+        session.commit()
+        return {"user_message": user_message, "conversation_id": conversation_id}, history
+
+@app.post("/api/chat")
+async def chat_stream(request: ChatRequest):
+    initial_data, history = await run_db_write(create_chat_turn, request)
 
     async def combined_stream():
-        yield f"data: {json.dumps(initial_data)}\n\n"
-        async for chunk in stream_ollama_response(request, conversation.id): yield chunk
+        yield sse_event(initial_data)
+        async for chunk in stream_ollama_response(request, initial_data["conversation_id"], history): yield chunk
     return StreamingResponse(combined_stream(), media_type="text/event-stream")
 
 
-@app.post("/api/regenerate")
-async def regenerate_from_prompt(request: RegenerateRequest):
+def replace_user_message(request: RegenerateRequest) -> tuple[dict, list]:
+    """删除被编辑的用户消息及其之后的所有消息并写入新的用户消息，在同一事务中读出上下文历史；返回发给前端的第一帧数据和历史"""
     with Session(engine) as session:
         original_message = session.get(ChatMessage, request.message_id)
         if not original_message or original_message.role != 'user': raise HTTPException(status_code=404, detail="Original user message not found")
         conversation_id = original_message.conversation_id
         timestamp_of_edit = original_message.created_at
         
-        messages_to_delete = session.exec(select(ChatMessage).where(ChatMessage.conversation_id == conversation_id).where(ChatMessage.created_at >= timestamp_of_edit)).all()
-        for msg in messages_to_delete: session.delete(msg)
-        
+        # 一条 DELETE 删除被编辑消息及其之后的所有消息，并与新消息的插入放在同一个事务里提交
+        session.exec(delete(ChatMessage).where(ChatMessage.conversation_id == conversation_id).where(ChatMessage.created_at >= timestamp_of_edit))
+
+        new_user_message = insert_chat_message(session, "user", request.new_prompt, conversation_id)
+        history = load_context_history(session, conversation_id)
         session.commit()
 
-        new_user_message = ChatMessage(role="user", content=request.new_prompt, conversation_id=conversation_id)
-        session.add(new_user_message); session.commit(); session.refresh(new_user_message)
+        return {"user_message": new_user_message, "conversation_id": conversation_id}, history
+
+@app.post("/api/regenerate")
+async def regenerate_from_prompt(request: RegenerateRequest):
+    initial_data, history = await run_db_write(replace_user_message, request)
+    conversation_id = initial_data["conversation_id"]
+    chat_request_for_stream = ChatRequest(prompt=request.new_prompt, conversation_id=conversation_id, model=request.model)
 
-        chat_request_for_stream = ChatRequest(prompt=request.new_prompt, conversation_id=conversation_id, model=request.model)
-        initial_data = {"user_message": new_user_message.model_dump(mode='json'), "conversation_id": conversation_id}
-    
     async def combined_stream():
-        yield f"data: {json.dumps(initial_data)}\n\n"
-        async for chunk in stream_ollama_response(chat_request_for_stream, conversation_id): yield chunk
+        yield sse_event(initial_data)
+        async for chunk in stream_ollama_response(chat_request_for_stream, conversation_id, history): yield chunk
     return StreamingResponse(combined_stream(), media_type="text/event-stream")
\ No newline at end of file
@@ -0,0 +1,165 @@
+import json
+from datetime import datetime, timedelta
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import event
+from sqlmodel import Session, create_engine
+
+import main
+
+
+@pytest.fixture(autouse=True)
+def isolated_app(tmp_path, monkeypatch):
+    # 使用临时数据库，避免写入仓库里的 database.db；模型列表缓存也按测试重置
+    engine = create_engine(f"sqlite:///{tmp_path / 'database.db'}", connect_args={"check_same_thread": False})
+    event.listen(engine, "connect", main.set_sqlite_pragmas)
+    monkeypatch.setattr(main, "engine", engine)
+    monkeypatch.setattr(main, "_models_cache", {"ts": float("-inf"), "data": []})
+
+
+def mock_ollama(monkeypatch, handler):
+    """让 on_startup 创建的 HTTP 客户端走 MockTransport，客户端仍由 on_shutdown 负责关闭"""
+    real_client = httpx.AsyncClient
+    monkeypatch.setattr(httpx, "AsyncClient", lambda **kwargs: real_client(transport=httpx.MockTransport(handler), **kwargs))
+
+
+def ollama_lines(*pieces):
+    lines = [{"message": {"role": "assistant", "content": piece}, "done": False} for piece in pieces]
+    lines.append({"message": {"role": "assistant", "content": ""}, "done": True})
+    return httpx.Response(200, content="\n".join(json.dumps(line) for line in lines).encode())
+
+
+def sse_frames(response):
+    return [json.loads(frame[len("data: "):]) for frame in response.text.split("\n\n") if frame.startswith("data: ")]
+
+
+def test_delete_conversation_while_streaming(monkeypatch):
+    def ollama(request):
+        if request.url.path == "/api/tags": return httpx.Response(200, json={"models": []})
+        # 模拟用户在回复生成过程中删除了这个对话
+        with main.engine.begin() as conn: conn.exec_driver_sql("DELETE FROM conversation")
+        return ollama_lines("Hi")
+
+    mock_ollama(monkeypatch, ollama)
+    with TestClient(main.app) as client:
+        frames = sse_frames(client.post("/api/chat", json={"prompt": "hello", "model": "m"}))
+        conversation_id = frames[0]["conversation_id"]
+
+        assert frames[-2]["done"]
+        assert "error" in frames[-1] and "saved" not in frames[-1]
+        assert client.get(f"/api/conversations/{conversation_id}").json() == []
+        with main.engine.connect() as conn:
+            assert conn.exec_driver_sql("SELECT count(*) FROM chatmessage").scalar() == 0
+
+
+def test_app_restarts_in_same_process():
+    for _ in range(2):
+        with TestClient(main.app) as client:
+            assert client.post("/api/chat", json={"prompt": "hi", "conversation_id": 999, "model": "m"}).status_code == 404
+
+
+def test_etag_matches():
+    etag = '"abc"'
+    assert main.etag_matches('"abc"', etag)
+    assert main.etag_matches('W/"abc"', etag)
+    assert main.etag_matches('"x", W/"abc"', etag)
+    assert main.etag_matches("*", etag)
+    assert not main.etag_matches('"x", "y"', etag)
+    assert not main.etag_matches(None, etag)
+
+
+BASELINE_SCHEMA = """
+    CREATE TABLE conversation (id INTEGER NOT NULL, title VARCHAR NOT NULL, created_at DATETIME NOT NULL, PRIMARY KEY (id));
+    CREATE INDEX ix_conversation_title ON conversation (title);
+    CREATE TABLE chatmessage (
+        id INTEGER NOT NULL, role VARCHAR NOT NULL, content VARCHAR NOT NULL, created_at DATETIME NOT NULL, conversation_id INTEGER,
+        PRIMARY KEY (id), FOREIGN KEY(conversation_id) REFERENCES conversation (id)
+    );
+    INSERT INTO conversation VALUES (1, 'kept', '2024-01-01 10:00:00.000000');
+    INSERT INTO chatmessage VALUES (1, 'user', 'hello', '2024-01-01 10:00:01.000000', 1);
+    INSERT INTO chatmessage VALUES (2, 'assistant', 'hi', '2024-01-01 10:00:02.500000', 1);
+    INSERT INTO chatmessage VALUES (3, 'user', 'orphan', '2024-01-01 10:00:03.000000', 2);
+"""
+
+
+def test_migrate_baseline_database():
+    # 按最初版本的表结构建库：外键没有 CASCADE、表不是 STRICT，且残留一条所属对话已删除的孤儿消息
+    with main.engine.begin() as conn:
+        conn.exec_driver_sql("PRAGMA foreign_keys=OFF")
+        conn.connection.executescript(BASELINE_SCHEMA)
+        conn.exec_driver_sql("PRAGMA foreign_keys=ON")
+
+    def snapshot():
+        with main.engine.connect() as conn:
+            return (
+                conn.exec_driver_sql("SELECT id, role, content, created_at, conversation_id FROM chatmessage ORDER BY id").fetchall(),
+                conn.exec_driver_sql("SELECT type, name, sql FROM sqlite_master ORDER BY name").fetchall(),
+            )
+
+    main.create_db_and_tables()
+    rows, schema = snapshot()
+    assert rows == [(1, "user", "hello", "2024-01-01 10:00:01.000000", 1), (2, "assistant", "hi", "2024-01-01 10:00:02.500000", 1)]
+    assert "ix_chatmessage_conv_created" in [name for _, name, _ in schema]
+    with main.engine.connect() as conn:
+        assert [fk.on_delete for fk in conn.exec_driver_sql("PRAGMA foreign_key_list(chatmessage)")] == ["CASCADE"]
+        assert conn.exec_driver_sql("PRAGMA table_list(chatmessage)").fetchone().strict == main.SQLITE_STRICT
+
+    # 已迁移的库再次启动时不应重建表或改动数据
+    main.create_db_and_tables()
+    assert snapshot() == (rows, schema)
+
+
+def test_regenerate_after_saved_reply(monkeypatch):
+    def ollama(request):
+        if request.url.path == "/api/tags": return httpx.Response(200, json={"models": []})
+        return ollama_lines("reply")
+
+    mock_ollama(monkeypatch, ollama)
+    with TestClient(main.app) as client:
+        conversation_id = sse_frames(client.post("/api/chat", json={"prompt": "first", "model": "m"}))[0]["conversation_id"]
+        client.post("/api/chat", json={"prompt": "second", "conversation_id": conversation_id, "model": "m"})
+        messages = client.get(f"/api/conversations/{conversation_id}").json()
+        assert [m["role"] for m in messages] == ["user", "assistant", "user", "assistant"]
+        first_user, first_reply, edited, _ = messages
+
+        # 助手回复由 save_assistant_message 写入，时间格式必须与 ORM 写入的一致，否则按 created_at 的删除会漏删或误删
+        client.post("/api/regenerate", json={"message_id": edited["id"], "new_prompt": "second, edited", "model": "m"})
+        messages = client.get(f"/api/conversations/{conversation_id}").json()
+        assert [m["id"] for m in messages[:2]] == [first_user["id"], first_reply["id"]]
+        assert [(m["role"], m["content"]) for m in messages[2:]] == [("user", "second, edited"), ("assistant", "reply")]
+
+
+def test_load_context_history_keeps_newest_within_budget():
+    main.create_db_and_tables()
+    size = main.CONTEXT_CHAR_LIMIT // 3 + 1 # 最新的两条在预算内，三条就超出
+    with Session(main.engine) as session:
+        conversation = main.Conversation(title="long")
+        session.add(conversation); session.flush()
+        start = datetime(2024, 1, 1)
+        for i in range(5):
+            session.add(main.ChatMessage(role="user" if i % 2 == 0 else "assistant", content=str(i) * size, created_at=start + timedelta(seconds=i), conversation_id=conversation.id))
+        session.flush()
+        history = main.load_context_history(session, conversation.id)
+
+    assert [(role, content) for role, content, _ in history] == [("assistant", "3" * size), ("user", "4" * size)]
+    assert history[-1].total_chars == size and history[0].total_chars == 2 * size <= main.CONTEXT_CHAR_LIMIT
+
+
+def test_stream_coalesces_tokens(monkeypatch):
+    tokens = [f"词{i} " for i in range(40)]
+
+    def ollama(request):
+        if request.url.path == "/api/tags": return httpx.Response(200, json={"models": []})
+        return ollama_lines(*tokens)
+
+    mock_ollama(monkeypatch, ollama)
+    with TestClient(main.app) as client:
+        frames = sse_frames(client.post("/api/chat", json={"prompt": "hello", "model": "m"}))
+
+    # 多个 token 合并成一帧发送，拼接后的正文与逐 token 发送时一致
+    contents = [frame["content"] for frame in frames if "content" in frame]
+    assert 1 < len(contents) < len(tokens)
+    assert "".join(contents) == "".join(tokens)
+    assert frames[-1]["saved"] and frames[-1]["message"]["content"] == "".join(tokens)